@@ -1,26 +1,40 @@
 from fastapi import FastAPI, Request, Depends, HTTPException, WebSocket, WebSocketDisconnect, Form, status, UploadFile, File
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
+from cachetools import TTLCache
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from aiosqlitepool import SQLiteConnectionPool
+import aiofiles
+import aiofiles.os
+import aiosqlite
+import base64
+import binascii
+import blake3
 import hashlib
-import json
+import hmac
+import orjson
 import asyncio
 import os
-import shutil
-from typing import List, Dict
+import re
+import secrets
+import time
+from typing import List, Dict, Optional, Set, Tuple
 from pathlib import Path
+from dataclasses import dataclass
 
 # Database setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./chat_app.db"
+DATABASE_PATH = "chat_app.db"
+SQLALCHEMY_DATABASE_URL = f"sqlite:///./{DATABASE_PATH}"
+# SQLAlchemy engine is used only for DDL (create_all) at import time
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 # Models
@@ -40,24 +54,76 @@ class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
     content = Column(Text, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     room = Column(String(50), default="general")
     
     # File fields
-    file_url = Column(String(500), nullable=True)
+    file_url = Column(String(500), nullable=True, index=True)  # content-addressed, may be shared
     file_name = Column(String(255), nullable=True)
-    file_size = Column(String(50), nullable=True)
+    file_size = Column(Integer, nullable=True)  # bytes
     file_type = Column(String(50), nullable=True)  # 'image', 'video', 'file'
     
     # Relationship with user
     user = relationship("User", back_populates="messages")
+    
+    # Recent history is read newest-first
+    __table_args__ = (
+        Index("ix_messages_created_at", created_at.desc()),
+    )
 
-# Create tables
+# Create tables (and indexes added after a table already existed)
 Base.metadata.create_all(bind=engine)
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+# Async connection pool for all queries
+async def sqlite_connection() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(DATABASE_PATH)
+    conn.row_factory = aiosqlite.Row
+    # WAL lets history reads run alongside message inserts
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA mmap_size=268435456")
+    await conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+pool = SQLiteConnectionPool(connection_factory=sqlite_connection)
+
+# Databases created before file_size became Integer keep a VARCHAR column,
+# so cast on read to always return ints
+FILE_SIZE_COLUMN_SQL = "CAST(messages.file_size AS INTEGER) AS file_size"
+
+# Messages joined with their author, only the columns the API returns
+MESSAGES_WITH_AUTHOR_SQL = (
+    "SELECT messages.id, messages.content, messages.user_id, messages.created_at, "
+    f"messages.file_url, messages.file_name, {FILE_SIZE_COLUMN_SQL}, messages.file_type, "
+    "users.username "
+    "FROM messages JOIN users ON users.id = messages.user_id"
+)
+RECENT_MESSAGES_SQL = MESSAGES_WITH_AUTHOR_SQL + " ORDER BY messages.created_at DESC LIMIT 50"
+
+# Hot-path statements shared by the websocket and HTTP paths
+USER_BY_USERNAME_SQL = "SELECT id, username, is_active FROM users WHERE username = ?"
+INSERT_TEXT_MESSAGE_SQL = (
+    "INSERT INTO messages (content, user_id, room, created_at) VALUES (?, ?, ?, ?)"
+)
+
+def parse_datetime(value: str) -> datetime:
+    # SQLite stores DATETIME columns as ISO-like text
+    return datetime.fromisoformat(value)
+
+def format_datetime(value: datetime) -> str:
+    return value.isoformat(sep=" ")
+
+def event_timestamp() -> str:
+    # Computed once per broadcast, shared by every recipient
+    return datetime.fromtimestamp(time.time_ns() / 1e9, tz=timezone.utc).isoformat(timespec="milliseconds")
 
 # FastAPI app
-app = FastAPI(title="Enterprise Chat")
+app = FastAPI(title="Enterprise Chat", default_response_class=ORJSONResponse)
 
 # Create upload directories
 UPLOAD_DIR = Path("static/uploads")
@@ -65,22 +131,62 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 (UPLOAD_DIR / "images").mkdir(exist_ok=True)
 (UPLOAD_DIR / "videos").mkdir(exist_ok=True)
 (UPLOAD_DIR / "files").mkdir(exist_ok=True)
+# Partial uploads live outside the public static tree until they are hashed
+UPLOAD_TMP_DIR = Path("upload_tmp")
+UPLOAD_TMP_DIR.mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+# Uploaded files are shared by content hash: placing a file and inserting its
+# row must not interleave with checking its references and unlinking it
+UPLOAD_FILES_LOCK = asyncio.Lock()
+
+def unlink_files(paths: List[str]):
+    # Blocking; call through asyncio.to_thread from handlers
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 # Templates and static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+# Pages without per-request content, rendered once
+STATIC_PAGES: Dict[str, bytes] = {
+    name: templates.get_template(name).render().encode()
+    for name in ("index.html", "register.html", "login.html")
+}
+
 # Auth
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 300
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Stored as base64(salt || sha256(salt || password))
+PASSWORD_SALT_BYTES = 16
+LEGACY_PASSWORD_HASH = re.compile(r"[0-9a-f]{64}")
+
 def get_password_hash(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    salt = secrets.token_bytes(PASSWORD_SALT_BYTES)
+    h = hashlib.sha256(salt)
+    h.update(password.encode())
+    return base64.b64encode(salt + h.digest()).decode()
 
 def verify_password(plain_password, hashed_password):
-    return hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
+    # Accounts created before salting store an unsalted hex digest
+    if LEGACY_PASSWORD_HASH.fullmatch(hashed_password):
+        digest = hashlib.sha256(plain_password.encode()).digest()
+        return hmac.compare_digest(digest, bytes.fromhex(hashed_password))
+    
+    try:
+        stored = base64.b64decode(hashed_password, validate=True)
+    except binascii.Error:
+        return False
+    salt, stored_digest = stored[:PASSWORD_SALT_BYTES], stored[PASSWORD_SALT_BYTES:]
+    h = hashlib.sha256(salt)
+    h.update(plain_password.encode())
+    return hmac.compare_digest(h.digest(), stored_digest)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -89,34 +195,69 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_db():
+    async with pool.connection() as conn:
+        yield conn
 
-# Simple session management
-logged_in_users = {}
+# User lookup cache: username -> snapshot, bounded and expiring
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_MAX_SIZE = 10_000
 
-def get_current_user_from_cookie(request: Request, db: Session = Depends(get_db)):
-    username = request.cookies.get("username")
-    if not username:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Not authenticated"
-        )
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: int
+    username: str
+    is_active: bool
+
+USER_CACHE: TTLCache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+async def get_user_by_username(db: aiosqlite.Connection, username: str) -> Optional[UserSnapshot]:
+    user = USER_CACHE.get(username)
+    if user is not None:
+        return user
+    
+    cursor = await db.execute(USER_BY_USERNAME_SQL, (username,))
+    row = await cursor.fetchone()
+    if row is None:
+        return None
+    
+    user = UserSnapshot(id=row["id"], username=row["username"], is_active=bool(row["is_active"]))
+    USER_CACHE[username] = user
+    return user
+
+def invalidate_cached_user(username: str):
+    USER_CACHE.pop(username, None)
+
+# Signed session cookie carrying {"uid": id, "un": username}
+SESSION_COOKIE_NAME = "session"
+SESSION_MAX_AGE_SECONDS = 3600
+session_serializer = URLSafeTimedSerializer(SECRET_KEY, salt="session")
+
+def create_session_cookie(user_id: int, username: str) -> str:
+    return session_serializer.dumps({"uid": user_id, "un": username})
+
+def get_session_user(request: Request) -> Optional[UserSnapshot]:
+    cookie = request.cookies.get(SESSION_COOKIE_NAME)
+    if not cookie:
+        return None
     
-    user = db.query(User).filter(User.username == username).first()
+    try:
+        data = session_serializer.loads(cookie, max_age=SESSION_MAX_AGE_SECONDS)
+    except BadSignature:
+        return None
+    return UserSnapshot(id=data["uid"], username=data["un"], is_active=True)
+
+def get_current_user_from_cookie(request: Request):
+    user = get_session_user(request)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found"
+            detail="Not authenticated"
         )
     
     return user
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: aiosqlite.Connection = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -134,66 +275,70 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
     
     # Get user from database
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.username == username).first()
-        if user is None:
-            raise credentials_exception
-        return user
-    finally:
-        db.close()
+    user = await get_user_by_username(db, username)
+    if user is None:
+        raise credentials_exception
+    return user
 
 # WebSocket manager for multiple users
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {"general": []}
+        self.active_connections: Dict[str, Set[WebSocket]] = {"general": set()}
         self.user_rooms: Dict[str, str] = {}  # username -> room
+        self.room_users: Dict[str, Set[str]] = {}  # room -> usernames
+        self.connection_users: Dict[WebSocket, Tuple[str, str]] = {}  # websocket -> (room, username)
 
     async def connect(self, websocket: WebSocket, username: str, room: str = "general"):
         await websocket.accept()
-        if room not in self.active_connections:
-            self.active_connections[room] = []
-        self.active_connections[room].append(websocket)
+        self.active_connections.setdefault(room, set()).add(websocket)
+        self.connection_users[websocket] = (room, username)
         self.user_rooms[username] = room
+        self.room_users.setdefault(room, set()).add(username)
         
         # Notify everyone that user joined
         await self.broadcast_json({
             "type": "user_joined",
             "username": username,
             "message": f"{username} joined the chat",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": event_timestamp(),
             "online_users": self.get_online_users(room)
         }, room)
 
-    def disconnect(self, websocket: WebSocket, username: str):
-        room = self.user_rooms.get(username, "general")
-        if room in self.active_connections and websocket in self.active_connections[room]:
-            self.active_connections[room].remove(websocket)
+    async def disconnect(self, websocket: WebSocket):
+        entry = self.connection_users.pop(websocket, None)
+        if entry is None:
+            return
+        room, username = entry
         
-        if username in self.user_rooms:
-            del self.user_rooms[username]
+        self.active_connections.get(room, set()).discard(websocket)
+        self.user_rooms.pop(username, None)
+        self.room_users.get(room, set()).discard(username)
         
         # Notify everyone that user left
-        asyncio.create_task(self.broadcast_json({
+        await self.broadcast_json({
             "type": "user_left",
             "username": username,
             "message": f"{username} left the chat",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": event_timestamp(),
             "online_users": self.get_online_users(room)
-        }, room))
+        }, room)
 
     async def broadcast_json(self, message: dict, room: str):
         if room in self.active_connections:
-            disconnected = []
-            for connection in self.active_connections[room]:
-                try:
-                    await connection.send_text(json.dumps(message))
-                except:
-                    disconnected.append(connection)
+            payload: bytes = orjson.dumps(message)
+            # Snapshot so connects/disconnects during the sends can't shift the pairing below
+            connections = tuple(self.active_connections[room])
+            results = await asyncio.gather(
+                *(connection.send_bytes(payload) for connection in connections),
+                return_exceptions=True
+            )
             
             # Remove disconnected clients
-            for connection in disconnected:
-                self.active_connections[room].remove(connection)
+            disconnected = {
+                connection for connection, result in zip(connections, results)
+                if isinstance(result, Exception)
+            }
+            self.active_connections[room] -= disconnected
 
     async def broadcast_message(self, message_data: dict, room: str = "general"):
         await self.broadcast_json({
@@ -202,11 +347,7 @@ class ConnectionManager:
         }, room)
 
     def get_online_users(self, room: str = "general"):
-        online_users = []
-        for username, user_room in self.user_rooms.items():
-            if user_room == room:
-                online_users.append(username)
-        return online_users
+        return list(self.room_users.get(room, ()))
 
     def get_room_for_user(self, username: str):
         return self.user_rooms.get(username, "general")
@@ -216,15 +357,15 @@ manager = ConnectionManager()
 # Routes
 @app.get("/")
 async def root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return HTMLResponse(STATIC_PAGES["index.html"])
 
 @app.get("/register")
 async def register_page(request: Request):
-    return templates.TemplateResponse("register.html", {"request": request})
+    return HTMLResponse(STATIC_PAGES["register.html"])
 
 @app.get("/login")
 async def login_page(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return HTMLResponse(STATIC_PAGES["login.html"])
 
 @app.get("/chat")
 async def chat_page(request: Request):
@@ -232,43 +373,46 @@ async def chat_page(request: Request):
     token = request.query_params.get("token")
     user = None
     
-    if token:
-        try:
-            user = get_current_user(token)
-        except:
-            pass
-    
-    # Fallback to cookie-based auth
-    if not user:
-        username = request.cookies.get("username")
-        if username and username in logged_in_users:
-            db = SessionLocal()
+    async with pool.connection() as db:
+        if token:
             try:
-                user = db.query(User).filter(User.username == username).first()
-            finally:
-                db.close()
-    
-    # If no valid user, redirect to login
-    if not user:
-        return RedirectResponse(url="/login")
-    
-    db = SessionLocal()
-    try:
-        # Get last 50 messages with user relationship
-        messages = db.query(Message).join(User).order_by(Message.created_at.desc()).limit(50).all()
-        messages.reverse()
+                user = await get_current_user(token, db)
+            except:
+                pass
+        
+        # Fallback to cookie-based auth
+        if not user:
+            user = get_session_user(request)
         
-        # Get online users
-        online_users = manager.get_online_users()
+        # If no valid user, redirect to login
+        if not user:
+            return RedirectResponse(url="/login")
         
-        return templates.TemplateResponse("chat.html", {
-            "request": request, 
-            "user": user,
-            "messages": messages,
-            "online_users": online_users
-        })
-    finally:
-        db.close()
+        # Get last 50 messages with their author
+        cursor = await db.execute(RECENT_MESSAGES_SQL)
+        rows = await cursor.fetchall()
+    
+    messages = [{
+        "id": row["id"],
+        "content": row["content"],
+        "username": row["username"],
+        "user_id": row["user_id"],
+        "created_at": parse_datetime(row["created_at"]),
+        "file_url": row["file_url"],
+        "file_name": row["file_name"],
+        "file_size": row["file_size"],
+        "file_type": row["file_type"]
+    } for row in reversed(rows)]
+    
+    # Get online users
+    online_users = manager.get_online_users()
+    
+    return templates.TemplateResponse("chat.html", {
+        "request": request, 
+        "user": user,
+        "messages": messages,
+        "online_users": online_users
+    })
 
 @app.post("/register")
 async def register(
@@ -277,35 +421,31 @@ async def register(
     email: str = Form(...),
     password: str = Form(...)
 ):
-    db = SessionLocal()
-    try:
-        existing_user = db.query(User).filter(
-            (User.username == username) | (User.email == email)
-        ).first()
-        
-        if existing_user:
-            raise HTTPException(status_code=400, detail="Username или email уже заняты")
-        
-        hashed_password = get_password_hash(password)
-        db_user = User(
-            username=username,
-            email=email,
-            hashed_password=hashed_password
-        )
-        
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
-        
-        return {"message": "Регистрация успешна! Теперь войдите."}
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
-    finally:
-        db.close()
+    async with pool.connection() as db:
+        try:
+            cursor = await db.execute(
+                "SELECT id FROM users WHERE username = ? OR email = ?", (username, email)
+            )
+            existing_user = await cursor.fetchone()
+            
+            if existing_user:
+                raise HTTPException(status_code=400, detail="Username или email уже заняты")
+            
+            hashed_password = get_password_hash(password)
+            await db.execute(
+                "INSERT INTO users (username, email, hashed_password, is_active) VALUES (?, ?, ?, 1)",
+                (username, email, hashed_password)
+            )
+            await db.commit()
+            invalidate_cached_user(username)
+            
+            return {"message": "Регистрация успешна! Теперь войдите."}
+            
+        except HTTPException:
+            raise
+        except Exception as e:
+            await db.rollback()
+            raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
 
 @app.post("/login")
 async def login(
@@ -313,42 +453,46 @@ async def login(
     username: str = Form(...),
     password: str = Form(...)
 ):
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.username == username).first()
-        if not user or not verify_password(password, user.hashed_password):
-            raise HTTPException(status_code=401, detail="Неверный username или пароль")
-        
-        # Create token
-        access_token = create_access_token(data={"sub": user.username})
-        
-        # Also store in simple session for fallback
-        logged_in_users[username] = True
-        
-        response = JSONResponse({
-            "access_token": access_token,
-            "token_type": "bearer",
-            "username": user.username,
-            "message": "Вход успешен!"
-        })
-        
-        # Set cookie for session fallback
-        response.set_cookie(
-            key="username",
-            value=username,
-            httponly=True,
-            max_age=3600
-        )
-        
-        return response
-        
-    finally:
-        db.close()
+    async with pool.connection() as db:
+        cursor = await db.execute("SELECT * FROM users WHERE username = ?", (username,))
+        user = await cursor.fetchone()
+    
+    if not user or not verify_password(password, user["hashed_password"]):
+        raise HTTPException(status_code=401, detail="Неверный username или пароль")
+    
+    # Upgrade unsalted legacy hashes now that we have the plain password
+    if LEGACY_PASSWORD_HASH.fullmatch(user["hashed_password"]):
+        async with pool.connection() as db:
+            await db.execute(
+                "UPDATE users SET hashed_password = ? WHERE id = ?",
+                (get_password_hash(password), user["id"])
+            )
+            await db.commit()
+    
+    # Create token
+    access_token = create_access_token(data={"sub": user["username"]})
+    
+    response = ORJSONResponse({
+        "access_token": access_token,
+        "token_type": "bearer",
+        "username": user["username"],
+        "message": "Вход успешен!"
+    })
+    
+    # Set signed cookie for session fallback
+    response.set_cookie(
+        key=SESSION_COOKIE_NAME,
+        value=create_session_cookie(user["id"], user["username"]),
+        httponly=True,
+        max_age=SESSION_MAX_AGE_SECONDS
+    )
+    
+    return response
 
 @app.get("/logout")
 async def logout():
     response = RedirectResponse(url="/")
-    response.delete_cookie("username")
+    response.delete_cookie(SESSION_COOKIE_NAME)
     return response
 
 @app.get("/online-users")
@@ -358,24 +502,21 @@ async def get_online_users():
 # API endpoints for messages
 @app.get("/api/messages")
 async def get_recent_messages():
-    db = SessionLocal()
-    try:
-        messages = db.query(Message).join(User).order_by(Message.created_at.desc()).limit(50).all()
-        messages.reverse()
-        
-        return [{
-            "id": msg.id,
-            "content": msg.content,
-            "username": msg.user.username,
-            "user_id": msg.user_id,
-            "created_at": msg.created_at.isoformat(),
-            "file_url": msg.file_url,
-            "file_name": msg.file_name,
-            "file_size": msg.file_size,
-            "file_type": msg.file_type
-        } for msg in messages]
-    finally:
-        db.close()
+    async with pool.connection() as db:
+        cursor = await db.execute(RECENT_MESSAGES_SQL)
+        messages = await cursor.fetchall()
+    
+    return [{
+        "id": msg["id"],
+        "content": msg["content"],
+        "username": msg["username"],
+        "user_id": msg["user_id"],
+        "created_at": parse_datetime(msg["created_at"]).isoformat(),
+        "file_url": msg["file_url"],
+        "file_name": msg["file_name"],
+        "file_size": msg["file_size"],
+        "file_type": msg["file_type"]
+    } for msg in reversed(messages)]
 
 @app.post("/api/messages")
 async def create_message(
@@ -383,42 +524,36 @@ async def create_message(
     message_data: dict
 ):
     # Get user from cookie
-    username = request.cookies.get("username")
-    if not username:
+    user = get_session_user(request)
+    if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    username = user.username
     
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.username == username).first()
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        db_message = Message(
-            content=message_data["content"],
-            user_id=user.id
+    created_at = datetime.utcnow()
+    async with pool.connection() as db:
+        cursor = await db.execute(
+            INSERT_TEXT_MESSAGE_SQL,
+            (message_data["content"], user.id, "general", format_datetime(created_at))
         )
-        db.add(db_message)
-        db.commit()
-        db.refresh(db_message)
-        
-        # Broadcast via WebSocket
-        room = manager.get_room_for_user(username)
-        await manager.broadcast_message({
-            "id": db_message.id,
-            "content": message_data["content"],
-            "username": username,
-            "user_id": user.id,
-            "created_at": db_message.created_at.isoformat(),
-            "room": room,
-            "file_url": None,
-            "file_name": None,
-            "file_size": None,
-            "file_type": None
-        }, room)
-        
-        return {"status": "ok", "message_id": db_message.id}
-    finally:
-        db.close()
+        await db.commit()
+        message_id = cursor.lastrowid
+    
+    # Broadcast via WebSocket
+    room = manager.get_room_for_user(username)
+    await manager.broadcast_message({
+        "id": message_id,
+        "content": message_data["content"],
+        "username": username,
+        "user_id": user.id,
+        "created_at": created_at.isoformat(),
+        "room": room,
+        "file_url": None,
+        "file_name": None,
+        "file_size": None,
+        "file_type": None
+    }, room)
+    
+    return {"status": "ok", "message_id": message_id}
 
 # File upload endpoint
 @app.post("/api/upload")
@@ -426,18 +561,17 @@ async def upload_files(
     request: Request,
     files: List[UploadFile] = File(...),
     content: str = Form(None),
-    db: Session = Depends(get_db)
+    db: aiosqlite.Connection = Depends(get_db)
 ):
-    username = request.cookies.get("username")
-    if not username:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    user = db.query(User).filter(User.username == username).first()
+    user = get_session_user(request)
     if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    username = user.username
     
+    temp_paths = []
     try:
         uploaded_messages = []
+        placements = []
         
         for file in files:
             # Determine file type
@@ -451,53 +585,93 @@ async def upload_files(
                 file_type = 'file'
                 subdir = 'files'
             
-            # Generate unique filename
+            # Save to a temporary file, hashing the content as it streams
             file_extension = Path(file.filename).suffix
-            unique_filename = f"{datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')}_{file.filename}"
-            file_path = UPLOAD_DIR / subdir / unique_filename
+            temp_path = UPLOAD_TMP_DIR / f"{time.time_ns()}_{secrets.token_hex(6)}"
+            temp_paths.append(str(temp_path))
+            content_hash = blake3.blake3()
+            file_size = 0
+            async with aiofiles.open(temp_path, "wb") as buffer:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    content_hash.update(chunk)
+                    await buffer.write(chunk)
+                    file_size += len(chunk)
             
-            # Save file
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            # Store by content hash so identical uploads share one file
+            digest = content_hash.hexdigest()
+            stored_name = f"{digest[:2]}/{digest}{file_extension}"
+            placements.append((temp_path, UPLOAD_DIR / subdir / stored_name))
             
-            # Create database record
-            db_message = Message(
-                content=content or f"Sent a {file_type}",
-                user_id=user.id,
-                file_url=f"/static/uploads/{subdir}/{unique_filename}",
-                file_name=file.filename,
-                file_size=str(file_path.stat().st_size),
-                file_type=file_type
-            )
-            db.add(db_message)
-            uploaded_messages.append(db_message)
-        
-        db.commit()
-        
-        # Refresh to get IDs
-        for message in uploaded_messages:
-            db.refresh(message)
+            uploaded_messages.append({
+                "content": content or f"Sent a {file_type}",
+                "file_url": f"/static/uploads/{subdir}/{stored_name}",
+                "file_name": file.filename,
+                "file_size": file_size,
+                "file_type": file_type
+            })
+        
+        created_at = datetime.utcnow()
+        async with UPLOAD_FILES_LOCK:
+            # Files this request put in place, as opposed to existing duplicates
+            placed_paths = []
+            try:
+                for temp_path, file_path in placements:
+                    if await aiofiles.os.path.exists(file_path):
+                        await aiofiles.os.remove(temp_path)
+                    else:
+                        await aiofiles.os.makedirs(file_path.parent, exist_ok=True)
+                        await aiofiles.os.replace(temp_path, file_path)
+                        placed_paths.append(str(file_path))
+                
+                # Create all database records in one statement
+                cursor = await db.execute(
+                    "INSERT INTO messages (content, user_id, room, created_at, file_url, file_name, file_size, file_type) VALUES "
+                    + ", ".join(["(?, ?, 'general', ?, ?, ?, ?, ?)"] * len(uploaded_messages))
+                    + " RETURNING id",
+                    [
+                        value
+                        for message in uploaded_messages
+                        for value in (
+                            message["content"],
+                            user.id,
+                            format_datetime(created_at),
+                            message["file_url"],
+                            message["file_name"],
+                            message["file_size"],
+                            message["file_type"]
+                        )
+                    ]
+                )
+                # RETURNING order is unspecified; rowids are assigned in VALUES order
+                inserted = sorted(await cursor.fetchall(), key=lambda row: row["id"])
+                await db.commit()
+            except Exception:
+                # Don't leave files without rows in the public tree
+                await asyncio.to_thread(unlink_files, placed_paths)
+                raise
         
         # Broadcast via WebSocket
         room = manager.get_room_for_user(username)
-        for message in uploaded_messages:
+        for message, row in zip(uploaded_messages, inserted):
             await manager.broadcast_message({
-                "id": message.id,
-                "content": message.content,
+                "id": row["id"],
+                "content": message["content"],
                 "username": username,
                 "user_id": user.id,
-                "created_at": message.created_at.isoformat(),
+                "created_at": created_at.isoformat(),
                 "room": room,
-                "file_url": message.file_url,
-                "file_name": message.file_name,
-                "file_size": message.file_size,
-                "file_type": message.file_type
+                "file_url": message["file_url"],
+                "file_name": message["file_name"],
+                "file_size": message["file_size"],
+                "file_type": message["file_type"]
             }, room)
         
         return {"status": "success", "message": "Files uploaded successfully"}
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
+        # Drop partial uploads that never made it into place
+        await asyncio.to_thread(unlink_files, temp_paths)
         raise HTTPException(status_code=500, detail=f"Error uploading files: {str(e)}")
 
 # PUT endpoint for editing messages
@@ -506,26 +680,26 @@ async def update_message(
     message_id: int,
     message_data: dict,
     request: Request,
-    db: Session = Depends(get_db)
+    db: aiosqlite.Connection = Depends(get_db)
 ):
     try:
         # Get current user from cookie
-        username = request.cookies.get("username")
-        if not username:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated"
-            )
-        
-        user = db.query(User).filter(User.username == username).first()
+        user = get_session_user(request)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found"
+                detail="Not authenticated"
             )
+        username = user.username
         
         # Find message
-        message = db.query(Message).filter(Message.id == message_id).first()
+        cursor = await db.execute(
+            "SELECT messages.id, messages.user_id, messages.created_at, messages.file_url, "
+            f"messages.file_name, {FILE_SIZE_COLUMN_SQL}, messages.file_type "
+            "FROM messages WHERE id = ?",
+            (message_id,)
+        )
+        message = await cursor.fetchone()
         if not message:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -533,31 +707,33 @@ async def update_message(
             )
         
         # Check if user owns the message
-        if message.user_id != user.id:
+        if message["user_id"] != user.id:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Can only edit your own messages"
             )
         
         # Update message content
-        message.content = message_data["content"]
-        db.commit()
+        await db.execute(
+            "UPDATE messages SET content = ? WHERE id = ?", (message_data["content"], message_id)
+        )
+        await db.commit()
         
         # Broadcast update via WebSocket
         room = manager.get_room_for_user(username)
         await manager.broadcast_json({
             "type": "message_updated",
             "message": {
-                "id": message.id,
-                "content": message.content,
+                "id": message["id"],
+                "content": message_data["content"],
                 "username": username,
                 "user_id": user.id,
-                "created_at": message.created_at.isoformat(),
+                "created_at": parse_datetime(message["created_at"]).isoformat(),
                 "room": room,
-                "file_url": message.file_url,
-                "file_name": message.file_name,
-                "file_size": message.file_size,
-                "file_type": message.file_type
+                "file_url": message["file_url"],
+                "file_name": message["file_name"],
+                "file_size": message["file_size"],
+                "file_type": message["file_type"]
             }
         }, room)
         
@@ -566,7 +742,7 @@ async def update_message(
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error updating message: {str(e)}"
@@ -577,26 +753,23 @@ async def update_message(
 async def delete_message(
     message_id: int, 
     request: Request,
-    db: Session = Depends(get_db)
+    db: aiosqlite.Connection = Depends(get_db)
 ):
     try:
         # Get current user from cookie
-        username = request.cookies.get("username")
-        if not username:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated"
-            )
-        
-        user = db.query(User).filter(User.username == username).first()
+        user = get_session_user(request)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found"
+                detail="Not authenticated"
             )
+        username = user.username
         
         # Find message
-        message = db.query(Message).filter(Message.id == message_id).first()
+        cursor = await db.execute(
+            "SELECT id, user_id, file_url FROM messages WHERE id = ?", (message_id,)
+        )
+        message = await cursor.fetchone()
         if not message:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -604,21 +777,28 @@ async def delete_message(
             )
         
         # Check if user owns the message
-        if message.user_id != user.id:
+        if message["user_id"] != user.id:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Can only delete your own messages"
             )
         
-        # Delete associated file if exists
-        if message.file_url:
-            file_path = message.file_url.replace('/static/', 'static/')
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        
-        # Delete message
-        db.delete(message)
-        db.commit()
+        async with UPLOAD_FILES_LOCK:
+            # Delete message
+            await db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            
+            # Delete associated file if no other message shares it
+            file_in_use = False
+            if message["file_url"]:
+                cursor = await db.execute(
+                    "SELECT 1 FROM messages WHERE file_url = ? LIMIT 1", (message["file_url"],)
+                )
+                file_in_use = await cursor.fetchone() is not None
+            await db.commit()
+            
+            if message["file_url"] and not file_in_use:
+                file_path = message["file_url"].replace('/static/', 'static/')
+                await asyncio.to_thread(unlink_files, [file_path])
         
         # Broadcast deletion via WebSocket
         room = manager.get_room_for_user(username)
@@ -636,7 +816,7 @@ async def delete_message(
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error deleting message: {str(e)}"
@@ -645,37 +825,43 @@ async def delete_message(
 @app.delete("/api/messages")
 async def clear_all_messages(
     request: Request,
-    db: Session = Depends(get_db)
+    db: aiosqlite.Connection = Depends(get_db)
 ):
     try:
         # Get current user from cookie
-        username = request.cookies.get("username")
-        if not username:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Not authenticated"
-            )
-        
-        user = db.query(User).filter(User.username == username).first()
+        user = get_session_user(request)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found"
+                detail="Not authenticated"
             )
         
-        # Get user's messages with files first to delete files
-        user_messages = db.query(Message).filter(Message.user_id == user.id).all()
-        
-        # Delete associated files
-        for message in user_messages:
-            if message.file_url:
-                file_path = message.file_url.replace('/static/', 'static/')
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+        # Get user's files first to delete them afterwards
+        cursor = await db.execute(
+            "SELECT DISTINCT file_url FROM messages WHERE user_id = ? AND file_url IS NOT NULL", (user.id,)
+        )
+        file_urls = {row["file_url"] for row in await cursor.fetchall()}
         
-        # Delete only user's messages
-        deleted_count = db.query(Message).filter(Message.user_id == user.id).delete()
-        db.commit()
+        async with UPLOAD_FILES_LOCK:
+            # Delete only user's messages
+            cursor = await db.execute("DELETE FROM messages WHERE user_id = ?", (user.id,))
+            deleted_count = cursor.rowcount
+            
+            # Keep files that other users' messages still point to
+            if file_urls:
+                cursor = await db.execute(
+                    "SELECT DISTINCT file_url FROM messages WHERE file_url IN ("
+                    + ", ".join("?" * len(file_urls)) + ")",
+                    tuple(file_urls)
+                )
+                file_urls -= {row["file_url"] for row in await cursor.fetchall()}
+            await db.commit()
+            
+            # Delete associated files in a single worker-thread hop
+            if file_urls:
+                await asyncio.to_thread(
+                    unlink_files, [file_url.replace('/static/', 'static/') for file_url in file_urls]
+                )
         
         return {
             "status": "success", 
@@ -684,7 +870,7 @@ async def clear_all_messages(
         }
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error clearing messages: {str(e)}"
@@ -692,20 +878,21 @@ async def clear_all_messages(
 
 # Debug endpoint to see all messages
 @app.get("/api/debug/messages")
-async def debug_messages(db: Session = Depends(get_db)):
+async def debug_messages(db: aiosqlite.Connection = Depends(get_db)):
     """Endpoint для отладки - показывает все сообщения"""
-    messages = db.query(Message).join(User).all()
+    cursor = await db.execute(MESSAGES_WITH_AUTHOR_SQL)
+    messages = await cursor.fetchall()
     return [
         {
-            "id": msg.id,
-            "content": msg.content,
-            "username": msg.user.username,
-            "user_id": msg.user_id,
-            "created_at": msg.created_at.isoformat(),
-            "file_url": msg.file_url,
-            "file_name": msg.file_name,
-            "file_size": msg.file_size,
-            "file_type": msg.file_type
+            "id": msg["id"],
+            "content": msg["content"],
+            "username": msg["username"],
+            "user_id": msg["user_id"],
+            "created_at": parse_datetime(msg["created_at"]).isoformat(),
+            "file_url": msg["file_url"],
+            "file_name": msg["file_name"],
+            "file_size": msg["file_size"],
+            "file_type": msg["file_type"]
         } for msg in messages
     ]
 
@@ -715,38 +902,36 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
     try:
         while True:
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = orjson.loads(data)
             
             if message_data.get("type") == "message":
                 content = message_data.get("content", "").strip()
                 if content:
-                    db = SessionLocal()
-                    try:
-                        user = db.query(User).filter(User.username == username).first()
+                    async with pool.connection() as db:
+                        user = await get_user_by_username(db, username)
                         if user:
-                            db_message = Message(
-                                content=content,
-                                user_id=user.id
+                            created_at = datetime.utcnow()
+                            cursor = await db.execute(
+                                INSERT_TEXT_MESSAGE_SQL,
+                                (content, user.id, "general", format_datetime(created_at))
                             )
-                            db.add(db_message)
-                            db.commit()
-                            db.refresh(db_message)
-                            
-                            room = manager.get_room_for_user(username)
-                            await manager.broadcast_message({
-                                "id": db_message.id,
-                                "content": content,
-                                "username": username,
-                                "user_id": user.id,
-                                "created_at": db_message.created_at.isoformat(),
-                                "room": room,
-                                "file_url": None,
-                                "file_name": None,
-                                "file_size": None,
-                                "file_type": None
-                            }, room)
-                    finally:
-                        db.close()
+                            await db.commit()
+                            message_id = cursor.lastrowid
+                    
+                    if user:
+                        room = manager.get_room_for_user(username)
+                        await manager.broadcast_message({
+                            "id": message_id,
+                            "content": content,
+                            "username": username,
+                            "user_id": user.id,
+                            "created_at": created_at.isoformat(),
+                            "room": room,
+                            "file_url": None,
+                            "file_name": None,
+                            "file_size": None,
+                            "file_type": None
+                        }, room)
                         
             # Handle WebSocket events for real-time updates
             elif message_data.get("type") == "message_updated":
@@ -755,13 +940,12 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                 await manager.broadcast_json(message_data, room)
                 
     except WebSocketDisconnect:
-        manager.disconnect(websocket, username)
+        await manager.disconnect(websocket)
 
 # Add test users on startup
 @app.on_event("startup")
 async def startup_event():
-    db = SessionLocal()
-    try:
+    async with pool.connection() as db:
         # Add test users if they don't exist
         test_users = [
             ("alex", "alex@example.com", "password123"),
@@ -770,21 +954,33 @@ async def startup_event():
         ]
         
         for username, email, password in test_users:
-            existing_user = db.query(User).filter(User.username == username).first()
+            cursor = await db.execute("SELECT id FROM users WHERE username = ?", (username,))
+            existing_user = await cursor.fetchone()
             if not existing_user:
                 hashed_password = get_password_hash(password)
-                user = User(
-                    username=username,
-                    email=email,
-                    hashed_password=hashed_password
+                await db.execute(
+                    "INSERT INTO users (username, email, hashed_password, is_active) VALUES (?, ?, ?, 1)",
+                    (username, email, hashed_password)
                 )
-                db.add(user)
                 print(f"✅ Создан тестовый пользователь: {username}")
         
-        db.commit()
-    finally:
-        db.close()
+        await db.commit()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await pool.close()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Keep a single worker: ConnectionManager state is per-process, so clients
+    # on different workers won't see each other's broadcasts, and
+    # UPLOAD_FILES_LOCK only serializes file dedup within one process
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        # Picks uvloop/httptools when installed (uvloop isn't available on Windows)
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )